@@ -0,0 +1,33 @@
+import iop
+import os
+import functools
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Create the IOP client from .env settings on first use and return the shared instance"""
+    return iop.IopClient(
+        os.getenv('IOP_API_URL'),
+        os.getenv('IOP_APP_KEY'),
+        os.getenv('IOP_APP_SECRET')
+    )
+
+
+def send_to_webhook(payload):
+    """Post an IOP response body to WEBHOOK_URL and print the outcome"""
+    import requests
+    
+    try:
+        webhook_response = requests.post(
+            os.getenv('WEBHOOK_URL'),
+            json=payload,
+            headers={'Content-Type': 'application/json'}
+        )
+        print(f"\nWebhook Status Code: {webhook_response.status_code}")
+        print(f"Webhook Response: {webhook_response.text}")
+    except Exception as e:
+        print(f"\nError sending to webhook: {e}")
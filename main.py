@@ -2,14 +2,24 @@ import iop
 import os
 import io
 import time
-import requests
-import boto3
+import shutil
+import asyncio
+import hashlib
+import contextlib
+import subprocess
+import functools
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import httpx
+import orjson
 from typing import Optional
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from PIL import Image
-from botocore.exceptions import ClientError
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,9 +27,13 @@ load_dotenv()
 app = FastAPI(
     title="IOP SDK API",
     description="FastAPI backend for Taobao Global IOP SDK",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# Compress larger responses such as full product listings
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Get environment variables
 IOP_API_URL = os.getenv('IOP_API_URL')
 IOP_APP_KEY = os.getenv('IOP_APP_KEY')
@@ -31,9 +45,107 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME')
 AWS_S3_REGION = os.getenv('AWS_S3_REGION', 'us-east-1')
 
+# Largest width or height allowed for processed images (Shopify limit)
+MAX_IMAGE_DIMENSION = 4000
+
+# Images with more pixels than this are refused before decoding (decompression bomb guard)
+MAX_IMAGE_PIXELS = MAX_IMAGE_DIMENSION * MAX_IMAGE_DIMENSION * 4
+
+# Largest image download accepted, in bytes
+MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+
+# Google's cwebp encoder is used for WebP output when installed, Pillow otherwise
+CWEBP_PATH = shutil.which('cwebp')
+
+# Seconds a single cwebp encode may take before it is killed
+CWEBP_TIMEOUT = 60
+
+# Successful /getProductInfo and /getProducts responses are reused for 60 seconds
+IOP_RESPONSE_CACHE = TTLCache(maxsize=10_000, ttl=60)
+
+# Upstream IOP calls currently in flight, keyed like the response cache
+IOP_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
+# Maximum number of IOP calls in flight when paginating a shop
+MAX_CONCURRENT_PAGE_REQUESTS = 8
+
+# Browser-like headers for image downloads. The shared client keeps connections
+# alive itself, and HTTP/2 forbids a Connection header, so none is sent.
+IMAGE_DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://www.aliexpress.com/',
+    'Sec-Fetch-Dest': 'image',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'cross-site'
+}
+
+# File extensions for raw images, by Content-Type
+IMAGE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'image/tiff': '.tiff'
+}
+
+# Server worker processes on this host, and image processes per worker. The
+# cores are split between workers so the host runs about one Pillow process per
+# core. `python main.py` sets WEB_WORKERS itself; when starting with
+# `uvicorn main:app` or gunicorn, set it to the worker count used there.
+CPU_COUNT = os.cpu_count() or 1
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', max(1, CPU_COUNT // WEB_WORKERS)))
+
+# Shared async HTTP client and image processing pool, created on startup
+http_client: Optional[httpx.AsyncClient] = None
+image_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+def create_image_pool():
+    """Create the process pool that runs Pillow work outside this worker's GIL"""
+    # forkserver avoids forking this process while to_thread and boto3 threads are running
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=IMAGE_POOL_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+def replace_broken_image_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    """Swap in a fresh image pool if the given broken pool is still the current one"""
+    global image_pool
+    if image_pool is pool:
+        image_pool = create_image_pool()
+        pool.shutdown(wait=False)
+
+
+@app.on_event("startup")
+async def startup():
+    """Create the shared async HTTP client and the image processing pool"""
+    global http_client, image_pool
+    image_pool = create_image_pool()
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+        timeout=30.0,
+        follow_redirects=True
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the shared async HTTP client and the image processing pool"""
+    await http_client.aclose()
+    image_pool.shutdown()
 
+
+@functools.lru_cache(maxsize=None)
 def get_s3_client():
-    """Create and return S3 client instance"""
+    """Create the S3 client on first use and return the shared instance"""
+    import boto3
     return boto3.client(
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
@@ -42,6 +154,28 @@ def get_s3_client():
     )
 
 
+# IOP client is built once at import and shared across requests
+IOP_CLIENT = iop.IopClient(IOP_API_URL, IOP_APP_KEY, IOP_APP_SECRET)
+
+# Large uploads are split into 8MB parts sent concurrently
+S3_TRANSFER_SETTINGS = {"multipart_threshold": 8 * 1024 * 1024, "max_concurrency": 8, "use_threads": True}
+
+# Uploaded keys are timestamped and never overwritten, so CDNs may cache them forever
+S3_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def upload_to_s3(data: bytes, key: str, content_type: str):
+    """Upload bytes to the S3 bucket, using a multipart upload for large files"""
+    from boto3.s3.transfer import TransferConfig
+    get_s3_client().upload_fileobj(
+        io.BytesIO(data),
+        AWS_S3_BUCKET_NAME,
+        key,
+        ExtraArgs={"ContentType": content_type, "CacheControl": S3_CACHE_CONTROL},
+        Config=TransferConfig(**S3_TRANSFER_SETTINGS)
+    )
+
+
 # Request models
 class AccessTokenRequest(BaseModel):
     code: str
@@ -68,6 +202,8 @@ class ImageProcessRequest(BaseModel):
     image_url: str
     variant_id: str = "product"
     quality: int = 85  # WebP quality (1-100)
+    method: int = Field(4, ge=0, le=6)  # WebP encoder effort (0-6), higher is smaller but slower
+    store_raw: bool = False  # Also upload the original image to S3
 
 
 # Response models
@@ -78,29 +214,162 @@ class APIResponse(BaseModel):
     error: Optional[str] = None
 
 
-def get_iop_client():
-    """Create and return IOP client instance"""
-    return iop.IopClient(IOP_API_URL, IOP_APP_KEY, IOP_APP_SECRET)
+def get_iop_cache_key(api_name: str, api_params: dict, access_token: str) -> tuple:
+    """Build a cache key from the API path, its parameters and a hash of the access token"""
+    token_hash = hashlib.sha256(access_token.encode()).hexdigest()
+    return (api_name, tuple(sorted(api_params.items())), token_hash)
+
+
+async def execute_and_cache(api_name: str, api_params: dict, access_token: str, cache_key: tuple):
+    """Build and execute an IOP request off the event loop and cache the response if it succeeded"""
+    iop_request = iop.IopRequest(api_name)
+    for key, value in api_params.items():
+        iop_request.add_api_param(key, value)
+    response = await asyncio.to_thread(IOP_CLIENT.execute, iop_request, access_token)
+    if response.code in (None, "0"):
+        IOP_RESPONSE_CACHE[cache_key] = response
+    return response
+
+
+async def cached_execute(api_name: str, api_params: dict, access_token: str):
+    """
+    Execute an IOP API call, reusing a recent successful response for the same call.
+    
+    Concurrent identical calls share a single upstream request. The cache and
+    the in-flight map are only touched from the event loop thread, so they
+    need no lock.
+    """
+    cache_key = get_iop_cache_key(api_name, api_params, access_token)
+    response = IOP_RESPONSE_CACHE.get(cache_key)
+    if response is not None:
+        return response
+    
+    task = IOP_INFLIGHT.get(cache_key)
+    if task is None:
+        # First caller starts the upstream call, concurrent callers join it
+        task = asyncio.create_task(execute_and_cache(api_name, api_params, access_token, cache_key))
+        IOP_INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _: IOP_INFLIGHT.pop(cache_key, None))
+    
+    # Shield the shared call so one caller disconnecting doesn't cancel it for the rest
+    return await asyncio.shield(task)
+
+
+def get_total_pages(page_data: dict, page_size: int) -> Optional[int]:
+    """Return the page count reported by a search response, or None if absent"""
+    if page_data.get("total_page") is not None:
+        return int(page_data["total_page"])
+    if page_data.get("total_count") is not None:
+        return -(-int(page_data["total_count"]) // page_size)
+    return None
+
+
+def check_image_pixels(image):
+    """
+    Refuse an opened image before its pixels are decoded if it exceeds MAX_IMAGE_PIXELS.
+    
+    Call it after any draft(), since a drafted JPEG is only ever decoded at the
+    reduced size. Pillow's own MAX_IMAGE_PIXELS check only raises at twice its
+    limit and merely warns below that, so the cap is enforced here instead.
+    """
+    from PIL import Image
+    
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({image.width * image.height} pixels) exceeds limit of {MAX_IMAGE_PIXELS} pixels"
+        )
+
+
+def convert_to_webp(raw_image_data: bytes, quality: int, method: int) -> tuple[bytes, int, int, int, int, bool]:
+    """
+    Decode an image, downscale it to fit within 4000px and encode it as WebP.
+    
+    Runs CPU-bound Pillow work, so call it in the image processing pool.
+    Returns (webp_data, original_width, original_height, new_width, new_height, was_resized).
+    """
+    from PIL import Image
+    
+    # Open image with Pillow
+    image = Image.open(io.BytesIO(raw_image_data))
+    
+    # Get original dimensions
+    original_width, original_height = image.size
+    
+    # Resize if either dimension exceeds 4000 pixels (Shopify limit)
+    needs_resize = False
+    new_width, new_height = original_width, original_height
+    
+    if original_width > MAX_IMAGE_DIMENSION or original_height > MAX_IMAGE_DIMENSION:
+        needs_resize = True
+        # Calculate scaling factor based on the larger dimension
+        if original_width >= original_height:
+            # Width is the larger dimension
+            scale_factor = MAX_IMAGE_DIMENSION / original_width
+            new_width = MAX_IMAGE_DIMENSION
+            new_height = round(original_height * scale_factor)
+        else:
+            # Height is the larger dimension
+            scale_factor = MAX_IMAGE_DIMENSION / original_height
+            new_height = MAX_IMAGE_DIMENSION
+            new_width = round(original_width * scale_factor)
+    
+        # Let libjpeg decode at a reduced scale that still covers the target size
+        if image.format == 'JPEG':
+            image.draft('RGB', (new_width, new_height))
+    
+    # Checked on the drafted size for JPEGs, the header size for everything else
+    check_image_pixels(image)
+    
+    if needs_resize:
+        # Resize image with high-quality resampling
+        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
+    # Convert to RGB if necessary (WebP doesn't support all modes)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Preserve transparency for RGBA
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    if CWEBP_PATH:
+        # Hand an uncompressed PNG to cwebp, which encodes natively with multi-threading
+        png_buffer = io.BytesIO()
+        image.save(png_buffer, format='PNG', compress_level=0)
+        result = subprocess.run(
+            [CWEBP_PATH, '-quiet', '-q', str(quality), '-m', str(method), '-mt', '-o', '-', '--', '-'],
+            input=png_buffer.getvalue(),
+            capture_output=True,
+            check=True,
+            timeout=CWEBP_TIMEOUT
+        )
+        webp_data = result.stdout
+    else:
+        # Save as WebP to bytes buffer; getvalue() hands over the buffer without copying
+        webp_buffer = io.BytesIO()
+        image.save(webp_buffer, format='WEBP', quality=quality, method=method)
+        webp_data = webp_buffer.getvalue()
+    
+    return webp_data, original_width, original_height, new_width, new_height, needs_resize
 
 
 @app.get("/")
-def root():
+async def root():
     """Health check endpoint"""
     return {"status": "ok", "message": "IOP SDK API is running"}
 
 
 @app.post("/getAccessToken", response_model=APIResponse)
-def get_access_token(request: AccessTokenRequest):
+async def get_access_token(request: AccessTokenRequest):
     """
     Generate access token using authorization code.
     
     - **code**: Authorization code from Taobao OAuth
     """
     try:
-        client = get_iop_client()
         iop_request = iop.IopRequest('/auth/token/create', 'GET')
         iop_request.add_api_param('code', request.code)
-        response = client.execute(iop_request)
+        response = await asyncio.to_thread(IOP_CLIENT.execute, iop_request)
         
         return APIResponse(
             success=True,
@@ -112,7 +381,7 @@ def get_access_token(request: AccessTokenRequest):
 
 
 @app.post("/getProductInfo", response_model=APIResponse)
-def get_product_info(request: ProductInfoRequest):
+async def get_product_info(request: ProductInfoRequest):
     """
     Get product information by item ID.
     
@@ -120,10 +389,7 @@ def get_product_info(request: ProductInfoRequest):
     - **access_token**: Valid access token
     """
     try:
-        client = get_iop_client()
-        iop_request = iop.IopRequest('/product/get')
-        iop_request.add_api_param('item_id', request.item_id)
-        response = client.execute(iop_request, request.access_token)
+        response = await cached_execute('/product/get', {'item_id': request.item_id}, request.access_token)
         
         return APIResponse(
             success=True,
@@ -137,7 +403,7 @@ def get_product_info(request: ProductInfoRequest):
 
 
 @app.post("/getProducts", response_model=APIResponse)
-def get_products(request: ProductsRequest):
+async def get_products(request: ProductsRequest):
     """
     Search/list products from a shop.
     
@@ -147,12 +413,12 @@ def get_products(request: ProductsRequest):
     - **access_token**: Valid access token
     """
     try:
-        client = get_iop_client()
-        iop_request = iop.IopRequest('/traffic/item/search')
-        iop_request.add_api_param('page_no', str(request.page_no))
-        iop_request.add_api_param('page_size', str(request.page_size))
-        iop_request.add_api_param('shop_id', request.shop_id)
-        response = client.execute(iop_request, request.access_token)
+        search_params = {
+            'page_no': str(request.page_no),
+            'page_size': str(request.page_size),
+            'shop_id': request.shop_id
+        }
+        response = await cached_execute('/traffic/item/search', search_params, request.access_token)
         
         return APIResponse(
             success=True,
@@ -165,68 +431,133 @@ def get_products(request: ProductsRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/getAllProducts", response_model=APIResponse)
-def get_all_products(request: AllProductsRequest):
+@app.post("/getAllProducts")
+async def get_all_products(request: AllProductsRequest):
     """
     Fetch all products from a shop by paginating through all pages.
     
     - **shop_id**: Shop ID to search products from
     - **access_token**: Valid access token
+    
+    Products are streamed as newline-delimited JSON, one product per line, in
+    the order their pages arrive, so only a few pages are held in memory. The
+    last line is {"done": true, "total_count": n}, or {"error": "..."} if a
+    page failed part way through.
     """
-    try:
-        client = get_iop_client()
-        all_products = []
-        page_no = 1
-        page_size = 20
+    page_size = 20
+    
+    async def fetch_page(page_no):
+        """Fetch one page of search results and return its data section"""
+        iop_request = iop.IopRequest('/traffic/item/search')
+        iop_request.add_api_param('page_no', str(page_no))
+        iop_request.add_api_param('page_size', str(page_size))
+        iop_request.add_api_param('shop_id', request.shop_id)
+        response = await asyncio.to_thread(IOP_CLIENT.execute, iop_request, request.access_token)
         
-        while True:
-            iop_request = iop.IopRequest('/traffic/item/search')
-            iop_request.add_api_param('page_no', str(page_no))
-            iop_request.add_api_param('page_size', str(page_size))
-            iop_request.add_api_param('shop_id', request.shop_id)
-            response = client.execute(iop_request, request.access_token)
-            
-            # Extract products from response
-            if isinstance(response.body, dict):
-                products = response.body.get("data", {}).get("data", [])
-            else:
-                products = []
-            
-            # If no products returned, stop pagination
-            if not products:
-                break
-            
-            all_products.extend(products)
-            
-            # If fewer products than page_size, we've reached the last page
-            if len(products) < page_size:
-                break
-            
-            page_no += 1
+        # Don't let an error page (e.g. ApiCallLimit) pass as an empty one
+        if response.code not in (None, "0"):
+            raise RuntimeError(f"Page {page_no} failed: {response.code} {response.message}")
         
-        return APIResponse(
-            success=True,
-            type="success",
-            data={
-                "products": all_products,
-                "total_count": len(all_products)
-            }
-        )
+        if isinstance(response.body, dict):
+            return response.body.get("data") or {}
+        return {}
+    
+    try:
+        # Fetch the first page up front so upstream failures still return a 500
+        page_data = await fetch_page(1)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    first_products = page_data.get("data", [])
+    total_pages = get_total_pages(page_data, page_size)
+    
+    async def generate_pages():
+        """Yield each page's products, fetching the remaining pages concurrently"""
+        yield first_products
+        
+        if total_pages is None:
+            # No page count in the response, walk pages until a short or empty one
+            products = first_products
+            page_no = 1
+            while len(products) >= page_size:
+                page_no += 1
+                products = (await fetch_page(page_no)).get("data", [])
+                yield products
+            return
+        
+        # A few fetchers share the remaining page numbers and hand pages over
+        # through a bounded queue, capping in-flight calls and buffered pages
+        page_numbers = iter(range(2, total_pages + 1))
+        queue = asyncio.Queue(maxsize=MAX_CONCURRENT_PAGE_REQUESTS)
+        
+        async def fetch_pages():
+            """Fetch pages until none are left, queueing their products or the error"""
+            try:
+                for page_no in page_numbers:
+                    await queue.put((await fetch_page(page_no)).get("data", []))
+            except Exception as e:
+                await queue.put(e)
+        
+        fetchers = [
+            asyncio.create_task(fetch_pages())
+            for _ in range(min(MAX_CONCURRENT_PAGE_REQUESTS, total_pages - 1))
+        ]
+        try:
+            for _ in range(total_pages - 1):
+                products = await queue.get()
+                if isinstance(products, Exception):
+                    raise products
+                yield products
+        finally:
+            for fetcher in fetchers:
+                fetcher.cancel()
+    
+    async def generate_products():
+        """
+        Yield each product as a JSON line, then a final status line.
+        
+        The last line is {"done": true, "total_count": n} when every page was
+        fetched, or {"error": "..."} when a later page failed, so clients can
+        tell a complete listing from a truncated one.
+        """
+        total_count = 0
+        try:
+            # aclosing() stops the page fetchers promptly if the client disconnects
+            async with contextlib.aclosing(generate_pages()) as pages:
+                async for products in pages:
+                    for product in products:
+                        yield orjson.dumps(product) + b"\n"
+                    total_count += len(products)
+        except Exception as e:
+            yield orjson.dumps({"error": str(e), "total_count": total_count}) + b"\n"
+            return
+        yield orjson.dumps({"done": True, "total_count": total_count}) + b"\n"
+    
+    return StreamingResponse(generate_products(), media_type="application/x-ndjson")
 
 
 @app.post("/processImage", response_model=APIResponse)
-def process_image(request: ImageProcessRequest):
+async def process_image(request: ImageProcessRequest):
     """
     Download an image from URL, convert to WebP format, and upload to S3.
     
     - **image_url**: URL of the image to process
     - **variant_id**: Product variant ID for file naming
     - **quality**: WebP quality (1-100, default: 85)
+    - **method**: WebP encoder effort (0-6, default: 4); 6 compresses best but is slowest
+    - **store_raw**: Also upload the original image to S3 (default: false)
     
-    Returns the public URL of the processed WebP image on S3.
+    WebP sources that already fit within 4000px are stored as-is instead of
+    being re-encoded.
+    
+    Returns the public URL of the processed WebP image on S3, plus the raw
+    image URL when **store_raw** is set.
     """
+    # Image and S3 dependencies are only loaded once this endpoint is used
+    from PIL import Image
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import ClientError
+    
     try:
         # Validate S3 configuration
         if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_BUCKET_NAME]):
@@ -240,135 +571,122 @@ def process_image(request: ImageProcessRequest):
         raw_filename = f"images/{request.variant_id}_{timestamp}_raw"
         processed_filename = f"images/{request.variant_id}_{timestamp}_processed.webp"
         
-        # Download image from URL with headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Referer': 'https://www.aliexpress.com/',
-            'Connection': 'keep-alive',
-            'Sec-Fetch-Dest': 'image',
-            'Sec-Fetch-Mode': 'no-cors',
-            'Sec-Fetch-Site': 'cross-site'
-        }
-        response = requests.get(request.image_url, headers=headers, timeout=30)
-        response.raise_for_status()
+        # Download image from URL with headers to mimic a browser, giving up
+        # as soon as it exceeds the size limit rather than buffering it all
+        async with http_client.stream('GET', request.image_url, headers=IMAGE_DOWNLOAD_HEADERS) as response:
+            response.raise_for_status()
+            # A missing or malformed Content-Length just means the size is unknown
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > MAX_DOWNLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image exceeds the 50MB download limit")
+            
+            # Determine original file extension from content-type
+            content_type = response.headers.get('Content-Type', 'image/jpeg')
+            
+            chunks = []
+            downloaded_bytes = 0
+            async for chunk in response.aiter_bytes():
+                downloaded_bytes += len(chunk)
+                if downloaded_bytes > MAX_DOWNLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="Image exceeds the 50MB download limit")
+                chunks.append(chunk)
         
-        # Determine original file extension from content-type
-        content_type = response.headers.get('Content-Type', 'image/jpeg')
-        ext_map = {
-            'image/jpeg': '.jpg',
-            'image/png': '.png',
-            'image/gif': '.gif',
-            'image/webp': '.webp',
-            'image/bmp': '.bmp',
-            'image/tiff': '.tiff'
-        }
-        original_ext = ext_map.get(content_type, '.jpg')
+        original_ext = IMAGE_EXTENSIONS.get(content_type, '.jpg')
         raw_filename_with_ext = f"{raw_filename}{original_ext}"
         
         # Get raw image data
-        raw_image_data = response.content
-        
-        # Initialize S3 client
-        s3_client = get_s3_client()
-        
-        # Upload raw image to S3
-        s3_client.put_object(
-            Bucket=AWS_S3_BUCKET_NAME,
-            Key=raw_filename_with_ext,
-            Body=raw_image_data,
-            ContentType=content_type
-        )
+        raw_image_data = b"".join(chunks)
         
-        # Convert image to WebP using Pillow
-        image = Image.open(io.BytesIO(raw_image_data))
+        # boto3 session setup isn't thread-safe, so create the client here before uploads start
+        get_s3_client()
         
-        # Get original dimensions
-        original_width, original_height = image.size
-        
-        # Resize if either dimension exceeds 4000 pixels (Shopify limit)
-        max_dimension = 4000
-        needs_resize = False
-        new_width, new_height = original_width, original_height
-        
-        if original_width > max_dimension or original_height > max_dimension:
-            needs_resize = True
-            # Calculate scaling factor based on the larger dimension
-            if original_width >= original_height:
-                # Width is the larger dimension
-                scale_factor = max_dimension / original_width
-                new_width = max_dimension
-                new_height = round(original_height * scale_factor)
-            else:
-                # Height is the larger dimension
-                scale_factor = max_dimension / original_height
-                new_height = max_dimension
-                new_width = round(original_width * scale_factor)
+        async def convert_and_upload():
+            """Convert the image to WebP in the process pool and upload the result"""
+            result = None
+            if content_type == 'image/webp':
+                # Reading the header is enough to tell if a WebP source already fits
+                source_image = Image.open(io.BytesIO(raw_image_data))
+                width, height = source_image.size
+                if source_image.format == 'WEBP' and width <= MAX_IMAGE_DIMENSION and height <= MAX_IMAGE_DIMENSION:
+                    result = (raw_image_data, width, height, width, height, False)
             
-            # Resize image with high-quality resampling
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Convert to RGB if necessary (WebP doesn't support all modes)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            # Preserve transparency for RGBA
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Save as WebP to bytes buffer
-        webp_buffer = io.BytesIO()
-        image.save(webp_buffer, format='WEBP', quality=request.quality, optimize=True)
-        webp_buffer.seek(0)
-        webp_data = webp_buffer.getvalue()
+            if result is None:
+                pool = image_pool
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        pool, convert_to_webp, raw_image_data, request.quality, request.method
+                    )
+                except BrokenProcessPool:
+                    # A pool process died (e.g. OOM-killed); fail this request but
+                    # give later ones a working pool
+                    replace_broken_image_pool(pool)
+                    raise
+            await asyncio.to_thread(upload_to_s3, result[0], processed_filename, 'image/webp')
+            return result
         
-        # Upload processed WebP image to S3
-        s3_client.put_object(
-            Bucket=AWS_S3_BUCKET_NAME,
-            Key=processed_filename,
-            Body=webp_data,
-            ContentType='image/webp'
-        )
+        uploads = [convert_and_upload()]
+        if request.store_raw:
+            # Upload the raw image while the WebP version is encoded and uploaded
+            uploads.append(asyncio.to_thread(upload_to_s3, raw_image_data, raw_filename_with_ext, content_type))
+        (webp_data, original_width, original_height, new_width, new_height, needs_resize), *_ = await asyncio.gather(*uploads)
         
         # Generate public URL for processed image
         processed_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{processed_filename}"
-        raw_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{raw_filename_with_ext}"
+        
+        data = {
+            "processed_url": processed_url,
+            "processed_filename": processed_filename,
+            "original_size_bytes": len(raw_image_data),
+            "processed_size_bytes": len(webp_data),
+            "compression_ratio": round((1 - len(webp_data) / len(raw_image_data)) * 100, 2),
+            "original_dimensions": {
+                "width": original_width,
+                "height": original_height,
+                "megapixels": round((original_width * original_height) / 1_000_000, 2)
+            },
+            "final_dimensions": {
+                "width": new_width,
+                "height": new_height,
+                "megapixels": round((new_width * new_height) / 1_000_000, 2)
+            },
+            "was_resized": needs_resize
+        }
+        if request.store_raw:
+            data["raw_url"] = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{raw_filename_with_ext}"
+            data["raw_filename"] = raw_filename_with_ext
         
         return APIResponse(
             success=True,
             type="success",
-            data={
-                "processed_url": processed_url,
-                "raw_url": raw_url,
-                "raw_filename": raw_filename_with_ext,
-                "processed_filename": processed_filename,
-                "original_size_bytes": len(raw_image_data),
-                "processed_size_bytes": len(webp_data),
-                "compression_ratio": round((1 - len(webp_data) / len(raw_image_data)) * 100, 2),
-                "original_dimensions": {
-                    "width": original_width,
-                    "height": original_height,
-                    "megapixels": round((original_width * original_height) / 1_000_000, 2)
-                },
-                "final_dimensions": {
-                    "width": new_width,
-                    "height": new_height,
-                    "megapixels": round((new_width * new_height) / 1_000_000, 2)
-                },
-                "was_resized": needs_resize
-            }
+            data=data
         )
-    except requests.exceptions.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=400, detail=f"Failed to download image: {str(e)}")
-    except ClientError as e:
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=400, detail=f"Image is too large to process: {str(e)}")
+    except (ClientError, S3UploadFailedError) as e:
         raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        # A timeout usually leaves no stderr, so fall back to the exception text
+        error = e.stderr.decode(errors='replace') if e.stderr else str(e)
+        raise HTTPException(status_code=500, detail=f"WebP encoding failed: {error}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # One worker per core by default so Pillow work scales past the GIL. The
+    # count is exported because workers re-import this module to size their pools.
+    workers = int(os.environ.setdefault('WEB_WORKERS', str(CPU_COUNT)))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
 